@@ -1,7 +1,9 @@
 import carla
 import pygame
 import numpy as np
-import time
+import cv2
+import queue
+import threading
 
 # Server details
 CARLA_SERVER_HOST = "ce-gpu.informatik.tu-chemnitz.de"
@@ -11,40 +13,91 @@ CARLA_SERVER_PORT = 2110
 display_width = 1000
 display_height = 800
 
-def carla_image_to_pygame(image):
-    """Convert CARLA camera image to Pygame format."""
-    array = np.frombuffer(image.raw_data, dtype=np.uint8)
-    array = array.reshape((image.height, image.width, 4))  # BGRA format
-    array = array[:, :, :3]  # Take RGB channels only
-    array = array[:, :, ::-1]  # Convert from BGR to RGB
-    return array
+# Camera capture resolution, upscaled to the display size when drawn
+capture_width = 500
+capture_height = 400
 
-def spawn_traffic_cars(world, blueprint_library, num_cars=5):
+# Batch commands for spawning traffic in a single round trip
+SpawnActor = carla.command.SpawnActor
+SetAutopilot = carla.command.SetAutopilot
+FutureActor = carla.command.FutureActor
+
+def carla_image_to_pygame(image, out=None):
+    """Convert CARLA camera image to Pygame format, optionally into a preallocated buffer."""
+    # View the BGRA bytes in place, one ndarray built straight on the buffer protocol
+    array = np.ndarray((image.height, image.width, 4), dtype=np.uint8, buffer=image.raw_data)
+    return cv2.cvtColor(array, cv2.COLOR_BGRA2RGB, dst=out)  # SIMD channel swap, C-contiguous result
+
+def put_latest(frame_queue, item):
+    """Put item on a single-slot queue, replacing whatever is still waiting there."""
+    try:
+        frame_queue.put_nowait(item)
+    except queue.Full:
+        try:
+            frame_queue.get_nowait()
+        except queue.Empty:
+            pass
+        frame_queue.put_nowait(item)
+
+def get_sensor_data(sensor_queue, frame, num_sensors, timeout=2.0):
+    """Collect one measurement per sensor for the given frame, discarding older ones."""
+    sensor_data = {}
+    stale = 0
+    while len(sensor_data) < num_sensors:
+        try:
+            name, data_frame, data = sensor_queue.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError(f"Timed out waiting for sensor data of frame {frame}") from None
+        if data_frame == frame:
+            sensor_data[name] = data
+        else:
+            stale += 1
+    return sensor_data, stale
+
+def convert_frames(raw_queue, converted_queue, frame_buffers):
+    """Conversion stage: write raw camera images into alternating RGB buffers, publish the buffer index."""
+    index = 0
+    while True:
+        image = raw_queue.get()
+        carla_image_to_pygame(image, out=frame_buffers[index])
+        put_latest(converted_queue, index)
+        index = 1 - index
+
+def spawn_traffic_cars(client, world, blueprint_library, num_cars=5, tm_port=8000):
     """Spawn traffic cars around the main car."""
     traffic_cars = []
     spawn_points = world.get_map().get_spawn_points()
+    vehicle_bp = blueprint_library.find('vehicle.tesla.model3')  # Same blueprint for every car
+    spawns = []
     for i in range(num_cars):
         # Random spawn point, but you can make this fixed as well
         spawn_point = spawn_points[i % len(spawn_points)]
-        vehicle_bp = blueprint_library.find('vehicle.tesla.model3')
-        vehicle = world.try_spawn_actor(vehicle_bp, spawn_point)
-        if vehicle:
-            traffic_cars.append(vehicle)
-            # Make the vehicle move
-            vehicle.set_autopilot(True)  # Vehicles will drive automatically
-            print(f"Spawned traffic car at {spawn_point.location}")
+        spawns.append((vehicle_bp, spawn_point))
+
+    # Spawn the whole batch in one round trip, autopilot is switched on server-side
+    batch = [SpawnActor(vehicle_bp, spawn_point).then(SetAutopilot(FutureActor, True, tm_port))
+             for vehicle_bp, spawn_point in spawns]
+    actor_ids = []
+    for (vehicle_bp, spawn_point), response in zip(spawns, client.apply_batch_sync(batch, True)):
+        if response.error:
+            print(f"Failed to spawn traffic car: {response.error}")
         else:
-            print("Failed to spawn traffic car.")
-    
+            actor_ids.append(response.actor_id)
+            print(f"Spawned traffic car at {spawn_point.location}")
+    traffic_cars.extend(world.get_actors(actor_ids))
     return traffic_cars
 
 def main():
     pygame.init()
     display = pygame.display.set_mode((display_width, display_height), pygame.HWSURFACE | pygame.DOUBLEBUF)
     pygame.display.set_caption("CARLA Simulation")
-    clock = pygame.time.Clock()
+    # QUIT is the only event the loop reacts to, keep everything else off the queue
+    pygame.event.set_blocked(None)
+    pygame.event.set_allowed(pygame.QUIT)
 
     traffic_cars = []  # Initialize traffic_cars to avoid reference errors
+    original_settings = None
+    traffic_manager = None
 
     try:
         # Connect to CARLA server
@@ -57,8 +110,19 @@ def main():
         client.load_world(town_name)
         world = client.get_world()
         
-        # Give time for the world to load
-        time.sleep(2)
+        # Block until the server delivers the first snapshot of the freshly loaded world
+        world.wait_for_tick(seconds=10.0)
+
+        # Run the server in lockstep with this client, one frame per world.tick()
+        original_settings = world.get_settings()
+        settings = world.get_settings()
+        settings.synchronous_mode = True
+        settings.fixed_delta_seconds = 1.0 / 30.0
+        world.apply_settings(settings)
+
+        # Autopilot vehicles are driven by the Traffic Manager, which has to tick along
+        traffic_manager = client.get_trafficmanager()
+        traffic_manager.set_synchronous_mode(True)
 
         # Get the blueprint library and list all available vehicles
         blueprint_library = world.get_blueprint_library()
@@ -87,47 +151,81 @@ def main():
         
         # Attach a camera for third-person view
         camera_bp = blueprint_library.find('sensor.camera.rgb')
-        camera_bp.set_attribute('image_size_x', str(display_width))
-        camera_bp.set_attribute('image_size_y', str(display_height))
+        camera_bp.set_attribute('image_size_x', str(capture_width))
+        camera_bp.set_attribute('image_size_y', str(capture_height))
         camera_bp.set_attribute('fov', '110')
 
         camera_transform = carla.Transform(carla.Location(x=-6.0, y=0, z=3.0), carla.Rotation(pitch=-15))
         camera = world.spawn_actor(camera_bp, camera_transform, attach_to=vehicle)
         
-        latest_image = None
-
-        def process_image(image):
-            nonlocal latest_image
-            latest_image = image
-
-        camera.listen(lambda image: process_image(image))
+        # Capture, conversion and display run as separate pipeline stages
+        raw_queue = queue.Queue(maxsize=1)
+        converted_queue = queue.Queue(maxsize=1)
+        frame_buffers = [np.empty((capture_height, capture_width, 3), dtype=np.uint8) for _ in range(2)]
+        # Each surface wraps one of the buffers, so frames are converted straight into its pixels
+        frame_surfaces = [pygame.image.frombuffer(buffer, (capture_width, capture_height), "RGB")
+                          for buffer in frame_buffers]
+        scaled_surface = pygame.Surface((display_width, display_height), 0, frame_surfaces[0])
+        threading.Thread(target=convert_frames, args=(raw_queue, converted_queue, frame_buffers), daemon=True).start()
+        dropped_frames = 0
+
+        # Every sensor reports into one queue, tagged with its name and frame number
+        sensor_queue = queue.Queue()
+        sensors = {'camera': camera}
+        for name, sensor in sensors.items():
+            sensor.listen(lambda data, name=name: sensor_queue.put((name, data.frame, data)))
 
         # Spawn additional traffic cars
-        traffic_cars = spawn_traffic_cars(world, blueprint_library, num_cars=10)
+        traffic_cars = spawn_traffic_cars(client, world, blueprint_library, num_cars=10,
+                                          tm_port=traffic_manager.get_port())
 
-        while True:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    return
+        # Prime the pipeline: sync up with the sensors (frames left over from the setup ticks
+        # are not drops) and start converting the first camera frame
+        sensor_data, _ = get_sensor_data(sensor_queue, world.tick(), len(sensors))
+        put_latest(raw_queue, sensor_data['camera'])
 
-            if latest_image:
-                image_array = carla_image_to_pygame(latest_image)
-                surface = pygame.surfarray.make_surface(image_array.swapaxes(0, 1))
-                display.blit(surface, (0, 0))
+        while True:
+            if pygame.event.peek(pygame.QUIT):
+                return
+
+            # Advance the simulation while the worker converts the previous tick's camera frame,
+            # so the display runs one tick behind the simulation
+            frame = world.tick()
+            sensor_data, stale = get_sensor_data(sensor_queue, frame, len(sensors))
+            dropped_frames += stale
+            if dropped_frames // 100 > (dropped_frames - stale) // 100:
+                print(f"Dropped {dropped_frames} stale sensor frames")
+
+            try:
+                index = converted_queue.get(timeout=2.0)  # Buffer holding the previous tick's frame
+            except queue.Empty:
+                raise RuntimeError("Timed out waiting for the conversion stage") from None
+            # This tick's frame goes into the other buffer while the previous one is drawn
+            put_latest(raw_queue, sensor_data['camera'])
+
+            pygame.transform.scale(frame_surfaces[index], (display_width, display_height), scaled_surface)
+            display.blit(scaled_surface, (0, 0))
 
             pygame.display.flip()
-            clock.tick(30)
 
     except Exception as e:
         print(f"Error: {e}")
     finally:
         pygame.quit()
+        if original_settings is not None:
+            world.apply_settings(original_settings)  # Hand the server back in asynchronous mode
+        if traffic_manager is not None:
+            traffic_manager.set_synchronous_mode(False)
+        # Destroy every spawned actor with a single batch instead of one RPC each
+        actors = []
         if 'camera' in locals() and camera is not None:
-            camera.destroy()
+            camera.stop()
+            actors.append(camera)
         if 'vehicle' in locals() and vehicle is not None:
-            vehicle.destroy()
-        for traffic_car in traffic_cars:
-            traffic_car.destroy()  # Cleanup traffic cars
+            actors.append(vehicle)
+        actors.extend(traffic_cars)  # Cleanup traffic cars
+        if actors:
+            client.apply_batch_sync([carla.command.DestroyActor(actor) for actor in actors], False)
 
 if __name__ == "__main__":
     main()